@@ -3,14 +3,12 @@
 # Licensed under a 3-clause BSD style license (see LICENSE)
 from __future__ import division
 
-from collections import OrderedDict, defaultdict
-
-from six import binary_type, iteritems
+from collections import defaultdict
 
 from datadog_checks.base.stubs.common import MetricStub, ServiceCheckStub
 from datadog_checks.base.stubs.similar import build_similar_elements_msg
 
-from ..utils.common import ensure_unicode, to_string
+from ..utils.common import ensure_unicode
 
 
 def normalize_tags(tags, sort=False):
@@ -31,89 +29,76 @@ class AggregatorStub(object):
     """
 
     # Replicate the Enum we have on the Agent
-    METRIC_ENUM_MAP = OrderedDict(
-        (
-            ('gauge', 0),
-            ('rate', 1),
-            ('count', 2),
-            ('monotonic_count', 3),
-            ('counter', 4),
-            ('histogram', 5),
-            ('historate', 6),
-        )
-    )
-    GAUGE, RATE, COUNT, MONOTONIC_COUNT, COUNTER, HISTOGRAM, HISTORATE = list(METRIC_ENUM_MAP.values())
-    AGGREGATE_TYPES = {COUNT, COUNTER}
+    GAUGE, RATE, COUNT, MONOTONIC_COUNT, COUNTER, HISTOGRAM, HISTORATE = range(7)
+    METRIC_ENUM_MAP = {
+        'gauge': GAUGE,
+        'rate': RATE,
+        'count': COUNT,
+        'monotonic_count': MONOTONIC_COUNT,
+        'counter': COUNTER,
+        'histogram': HISTOGRAM,
+        'historate': HISTORATE,
+    }
+    AGGREGATE_TYPES = frozenset((COUNT, COUNTER))
 
     def __init__(self):
         self._metrics = defaultdict(list)
+        self._metric_index = defaultdict(list)
         self._asserted = set()
         self._service_checks = defaultdict(list)
+        self._service_check_index = defaultdict(list)
         self._events = []
+        self._similar_elements_msgs = {}
 
     @classmethod
     def is_aggregate(cls, mtype):
         return mtype in cls.AGGREGATE_TYPES
 
     def submit_metric(self, check, check_id, mtype, name, value, tags, hostname):
-        self._metrics[name].append(MetricStub(name, mtype, value, tags, hostname))
+        # Decode once here so that queries don't have to on every call
+        name = ensure_unicode(name)
+        tags = normalize_tags(tags)
+        stub = MetricStub(name, mtype, value, tags, ensure_unicode(hostname))
+        self._metrics[name].append(stub)
+        self._metric_index[(name, tuple(sorted(tags or ())))].append(stub)
 
     def submit_service_check(self, check, check_id, name, status, tags, hostname, message):
-        self._service_checks[name].append(ServiceCheckStub(check_id, name, status, tags, hostname, message))
+        name = ensure_unicode(name)
+        tags = normalize_tags(tags)
+        stub = ServiceCheckStub(
+            ensure_unicode(check_id), name, status, tags, ensure_unicode(hostname), ensure_unicode(message)
+        )
+        self._service_checks[name].append(stub)
+        self._service_check_index[(name, tuple(sorted(tags or ())))].append(stub)
 
     def submit_event(self, check, check_id, event):
+        event = {
+            ensure_unicode(key): ensure_unicode(value) if isinstance(value, bytes) and key != 'host' else value
+            for key, value in event.items()
+        }
+        if event.get('tags'):
+            event['tags'] = normalize_tags(event['tags'])
+
         self._events.append(event)
 
     def metrics(self, name):
         """
         Return the metrics received under the given name
         """
-        return [
-            MetricStub(
-                ensure_unicode(stub.name),
-                stub.type,
-                stub.value,
-                normalize_tags(stub.tags),
-                ensure_unicode(stub.hostname),
-            )
-            for stub in self._metrics.get(to_string(name), [])
-        ]
+        return list(self._metrics.get(ensure_unicode(name), []))
 
     def service_checks(self, name):
         """
         Return the service checks received under the given name
         """
-        return [
-            ServiceCheckStub(
-                ensure_unicode(stub.check_id),
-                ensure_unicode(stub.name),
-                stub.status,
-                normalize_tags(stub.tags),
-                ensure_unicode(stub.hostname),
-                ensure_unicode(stub.message),
-            )
-            for stub in self._service_checks.get(to_string(name), [])
-        ]
+        return list(self._service_checks.get(ensure_unicode(name), []))
 
     @property
     def events(self):
         """
         Return all events
         """
-        all_events = [{ensure_unicode(key): value for key, value in iteritems(ev)} for ev in self._events]
-
-        for ev in all_events:
-            to_decode = []
-            for key, value in iteritems(ev):
-                if isinstance(value, binary_type) and key != 'host':
-                    to_decode.append(key)
-            for key in to_decode:
-                ev[key] = ensure_unicode(ev[key])
-
-            if ev.get('tags'):
-                ev['tags'] = normalize_tags(ev['tags'])
-
-        return all_events
+        return self._events
 
     def assert_metric_has_tag(self, metric_name, tag, count=None, at_least=1):
         """
@@ -134,17 +119,24 @@ class AggregatorStub(object):
     # Potential kwargs: aggregation_key, alert_type, event_type,
     # msg_title, source_type_name
     def assert_event(self, msg_text, count=None, at_least=1, exact_match=True, tags=None, **kwargs):
+        tags = frozenset(tags) if tags else None
+
         candidates = []
-        for e in self.events:
-            if exact_match and msg_text != e['msg_text'] or msg_text not in e['msg_text']:
+        for e in self._events:
+            if exact_match:
+                if msg_text != e['msg_text']:
+                    continue
+            elif msg_text not in e['msg_text']:
                 continue
-            if tags and set(tags) != set(e['tags']):
+            if tags is not None and tags != frozenset(e['tags']):
                 continue
-            for name, value in iteritems(kwargs):
+            for name, value in kwargs.items():
                 if e[name] != value:
                     break
             else:
                 candidates.append(e)
+                if count is None and len(candidates) >= at_least:
+                    break
 
         msg = ("Candidates size assertion for {0}, count: {1}, " "at_least: {2}) failed").format(
             msg_text, count, at_least
@@ -162,12 +154,19 @@ class AggregatorStub(object):
         self._asserted.add(name)
         tags = normalize_tags(tags, sort=True)
 
-        candidates = []
-        for metric in self.metrics(name):
-            if value is not None and not self.is_aggregate(metric.type) and value != metric.value:
-                continue
+        # Stubs are indexed by their sorted tags, so only the remaining fields need to be compared
+        if tags:
+            submitted = self._metric_index.get((ensure_unicode(name), tuple(tags)), [])
+        else:
+            submitted = self._metrics.get(ensure_unicode(name), [])
 
-            if tags and tags != sorted(metric.tags):
+        aggregate_types = self.AGGREGATE_TYPES
+        # Aggregate types are summed over all candidates when a value is expected
+        stop_early = count is None and value is None
+
+        candidates = []
+        for metric in submitted:
+            if value is not None and metric.type not in aggregate_types and value != metric.value:
                 continue
 
             if hostname and hostname != metric.hostname:
@@ -177,10 +176,10 @@ class AggregatorStub(object):
                 continue
 
             candidates.append(metric)
+            if stop_early and len(candidates) >= at_least:
+                break
 
-        expected_metric = MetricStub(name, metric_type, value, tags, hostname)
-
-        if value is not None and candidates and all(self.is_aggregate(m.type) for m in candidates):
+        if value is not None and candidates and all(m.type in aggregate_types for m in candidates):
             got = sum(m.value for m in candidates)
             msg = "Expected count value for '{}': {}, got {}".format(name, value, got)
             condition = value == got
@@ -190,21 +189,39 @@ class AggregatorStub(object):
         else:
             msg = "Needed at least {} candidates for '{}', got {}".format(at_least, name, len(candidates))
             condition = len(candidates) >= at_least
-        self._assert(condition, msg=msg, expected_stub=expected_metric, submitted_elements=self._metrics)
+        self._assert(
+            condition,
+            msg=msg,
+            build_failure_msg=lambda: self._build_similar_elements_msg(
+                MetricStub(name, metric_type, value, tags, hostname), self._metrics
+            ),
+        )
+
+    def assert_metrics_present(self, names, at_least=1):
+        """
+        Assert each of the given metrics was processed by this stub at least `at_least` times
+        """
+        names = [ensure_unicode(name) for name in names]
+        self._asserted.update(names)
+
+        missing = [name for name in names if len(self._metrics.get(name, ())) < at_least]
+        assert not missing, "Needed at least {} candidates for each of: {}".format(at_least, ', '.join(missing))
 
     def assert_service_check(self, name, status=None, tags=None, count=None, at_least=1, hostname=None, message=None):
         """
         Assert a service check was processed by this stub
         """
         tags = normalize_tags(tags, sort=True)
+        if tags:
+            submitted = self._service_check_index.get((ensure_unicode(name), tuple(tags)), [])
+        else:
+            submitted = self._service_checks.get(ensure_unicode(name), [])
+
         candidates = []
-        for sc in self.service_checks(name):
+        for sc in submitted:
             if status is not None and status != sc.status:
                 continue
 
-            if tags and tags != sorted(sc.tags):
-                continue
-
             if hostname is not None and hostname != sc.hostname:
                 continue
 
@@ -212,10 +229,8 @@ class AggregatorStub(object):
                 continue
 
             candidates.append(sc)
-
-        expected_service_check = ServiceCheckStub(
-            None, name=name, status=status, tags=tags, hostname=hostname, message=message
-        )
+            if count is None and len(candidates) >= at_least:
+                break
 
         if count is not None:
             msg = "Needed exactly {} candidates for '{}', got {}".format(count, name, len(candidates))
@@ -224,14 +239,27 @@ class AggregatorStub(object):
             msg = "Needed at least {} candidates for '{}', got {}".format(at_least, name, len(candidates))
             condition = len(candidates) >= at_least
         self._assert(
-            condition=condition, msg=msg, expected_stub=expected_service_check, submitted_elements=self._service_checks
+            condition,
+            msg=msg,
+            build_failure_msg=lambda: self._build_similar_elements_msg(
+                ServiceCheckStub(None, name=name, status=status, tags=tags, hostname=hostname, message=message),
+                self._service_checks,
+            ),
         )
 
+    def _build_similar_elements_msg(self, expected_stub, submitted_elements):
+        # Stubs are only ever appended between resets, so their count identifies what has been submitted.
+        # This avoids scoring every submitted element again when the same assertion fails repeatedly.
+        key = (repr(expected_stub), sum(len(stubs) for stubs in submitted_elements.values()))
+        if key not in self._similar_elements_msgs:
+            self._similar_elements_msgs[key] = build_similar_elements_msg(expected_stub, submitted_elements)
+        return self._similar_elements_msgs[key]
+
     @staticmethod
-    def _assert(condition, msg, expected_stub, submitted_elements):
+    def _assert(condition, msg, build_failure_msg):
         new_msg = msg
         if not condition:  # It's costly to build the message with similar metrics, so it's built only on failure.
-            new_msg = "{}\n{}".format(msg, build_similar_elements_msg(expected_stub, submitted_elements))
+            new_msg = "{}\n{}".format(msg, build_failure_msg())
         assert condition, new_msg
 
     def assert_all_metrics_covered(self):
@@ -241,10 +269,13 @@ class AggregatorStub(object):
         """
         Set the stub to its initial state
         """
-        self._metrics = defaultdict(list)
-        self._asserted = set()
-        self._service_checks = defaultdict(list)
-        self._events = []
+        self._metrics.clear()
+        self._metric_index.clear()
+        self._asserted.clear()
+        self._service_checks.clear()
+        self._service_check_index.clear()
+        del self._events[:]
+        self._similar_elements_msgs.clear()
 
     def all_metrics_asserted(self):
         assert self.metrics_asserted_pct >= 100.0
@@ -252,7 +283,6 @@ class AggregatorStub(object):
     def not_asserted(self):
         metrics_not_asserted = []
         for metric in self._metrics:
-            metric = ensure_unicode(metric)
             if metric not in self._asserted:
                 metrics_not_asserted.append(metric)
         return metrics_not_asserted
@@ -262,9 +292,7 @@ class AggregatorStub(object):
         self._asserted.add(metric_name)
 
         for metric in self.metrics(metric_name):
-            tags = metric.tags
-            gtags = [t for t in tags if t.startswith(tag_prefix)]
-            if len(gtags) > 0:
+            if any(t.startswith(tag_prefix) for t in metric.tags):
                 candidates.append(metric)
 
         if count is not None:
@@ -293,14 +321,14 @@ class AggregatorStub(object):
         """
         Return all the metric names we've seen so far
         """
-        return [ensure_unicode(name) for name in self._metrics.keys()]
+        return list(self._metrics)
 
     @property
     def service_check_names(self):
         """
         Return all the service checks names seen so far
         """
-        return [ensure_unicode(name) for name in self._service_checks.keys()]
+        return list(self._service_checks)
 
 
 # Use the stub as a singleton
@@ -0,0 +1,39 @@
+# (C) Datadog, Inc. 2019
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import pytest
+
+from datadog_checks.base import AgentCheck
+
+
+class TestAssertMetricsPresent(object):
+    def test_present(self, aggregator):
+        check = AgentCheck()
+
+        check.gauge('test.metric1', 0)
+        check.gauge('test.metric2', 0)
+        check.gauge('test.metric2', 1, tags=['foo:bar'])
+
+        aggregator.assert_metrics_present(['test.metric1', 'test.metric2'])
+        aggregator.assert_metrics_present(['test.metric2'], at_least=2)
+        aggregator.assert_all_metrics_covered()
+
+    def test_missing(self, aggregator):
+        check = AgentCheck()
+
+        check.gauge('test.metric1', 0)
+        check.gauge('test.metric2', 0)
+
+        with pytest.raises(AssertionError) as e:
+            aggregator.assert_metrics_present(['test.metric1', 'test.metric2', 'test.metric3'], at_least=2)
+
+        assert 'Needed at least 2 candidates for each of: test.metric1, test.metric2, test.metric3' in str(e.value)
+
+    def test_at_least_zero(self, aggregator):
+        check = AgentCheck()
+
+        check.gauge('test.metric1', 0)
+
+        aggregator.assert_metrics_present(['test.metric1', 'test.metric2'], at_least=0)
+        aggregator.assert_all_metrics_covered()
+        assert aggregator.not_asserted() == []
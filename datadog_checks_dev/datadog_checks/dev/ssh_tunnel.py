@@ -4,10 +4,10 @@
 from __future__ import absolute_import
 
 import os
+import signal
 import socket
 from contextlib import closing, contextmanager
 
-import psutil
 from six import PY3
 
 from .conditions import WaitForPortListening
@@ -18,25 +18,36 @@ from .utils import ON_WINDOWS
 if PY3:
     import subprocess
 else:
+    # TODO: Remove psutil as a dependency when we drop Python 2
+    import psutil
     import subprocess32 as subprocess
 
 PID_FILE = 'ssh.pid'
 
+# The outbound IP doesn't change during a test session, so it's only looked up once
+_outbound_ip = None
+
 
 def find_free_port(ip):
     """Return a port available for listening on the given `ip`."""
     with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        s.bind((ip, 0))
+        # Must be set before binding to have any effect
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((ip, 0))
         return s.getsockname()[1]
 
 
 def get_ip():
     """Return the IP address used to connect to external networks."""
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
-        # doesn't even have to be reachable
-        s.connect(('10.255.255.255', 1))
-        return s.getsockname()[0]
+    global _outbound_ip
+
+    if _outbound_ip is None:
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+            # doesn't even have to be reachable
+            s.connect(('10.255.255.255', 1))
+            _outbound_ip = s.getsockname()[0]
+
+    return _outbound_ip
 
 
 def run_background_command(command, pid_filename):
@@ -45,8 +56,8 @@ def run_background_command(command, pid_filename):
         process = subprocess.Popen(command, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
     else:
         process = subprocess.Popen(command, start_new_session=True)
-    with open(pid_filename, 'w') as pid_file:
-        pid_file.write(str(process.pid))
+    with open(pid_filename, 'wb') as pid_file:
+        pid_file.write(b'%d' % process.pid)
 
 
 @contextmanager
@@ -161,9 +172,11 @@ class KillProcess(LazyFunction):
 
     def __call__(self):
         with TempDir(self.temp_name) as temp_dir:
-            with open(os.path.join(temp_dir, self.pid_file)) as pid_file:
+            with open(os.path.join(temp_dir, self.pid_file), 'rb') as pid_file:
                 pid = int(pid_file.read())
-                # TODO: Remove psutil as a dependency when we drop Python 2, on Python 3 os.kill supports Windows
-                process = psutil.Process(pid)
-                process.kill()
+                if PY3:
+                    # On Windows any signal other than CTRL_C_EVENT/CTRL_BREAK_EVENT terminates the process
+                    os.kill(pid, signal.SIGTERM if ON_WINDOWS else signal.SIGKILL)
+                else:
+                    psutil.Process(pid).kill()
                 return 0
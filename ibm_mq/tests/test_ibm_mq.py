@@ -5,7 +5,6 @@
 import logging
 
 import pytest
-from six import iteritems
 
 from datadog_checks.base import AgentCheck
 from datadog_checks.ibm_mq import IbmMqCheck
@@ -21,11 +20,8 @@ def test_service_check_connection_issues(aggregator, instance, seed_data):
     check = IbmMqCheck('ibm_mq', {}, {})
     check.check(instance)
 
-    for metric in METRICS:
-        aggregator.assert_metric(metric)
-
-    for metric in OPTIONAL_METRICS:
-        aggregator.assert_metric(metric, at_least=0)
+    aggregator.assert_metrics_present(METRICS)
+    aggregator.assert_metrics_present(OPTIONAL_METRICS, at_least=0)
 
     aggregator.assert_all_metrics_covered()
 
@@ -61,13 +57,10 @@ def test_service_check_from_status(aggregator, instance, seed_data):
         pymqi.CMQCFC.MQCHS_INITIALIZING: AgentCheck.WARNING,
     }
 
-    for status in service_check_map:
-        check._submit_status_check('my_channel', status, ["channel:my_channel_{}".format(status)])
-
-    for status, service_check_status in iteritems(service_check_map):
-        aggregator.assert_service_check(
-            'ibm_mq.channel.status', service_check_status, tags=["channel:my_channel_{}".format(status)]
-        )
+    for status, service_check_status in service_check_map.items():
+        tags = ["channel:my_channel_{}".format(status)]
+        check._submit_status_check('my_channel', status, tags)
+        aggregator.assert_service_check('ibm_mq.channel.status', service_check_status, tags=tags)
 
 
 @pytest.mark.usefixtures("dd_environment")
@@ -75,11 +68,8 @@ def test_check_queue_pattern(aggregator, instance_queue_pattern, seed_data):
     check = IbmMqCheck('ibm_mq', {}, {})
     check.check(instance_queue_pattern)
 
-    for metric in METRICS:
-        aggregator.assert_metric(metric)
-
-    for metric in OPTIONAL_METRICS:
-        aggregator.assert_metric(metric, at_least=0)
+    aggregator.assert_metrics_present(METRICS)
+    aggregator.assert_metrics_present(OPTIONAL_METRICS, at_least=0)
 
     aggregator.assert_all_metrics_covered()
 
@@ -89,11 +79,8 @@ def test_check_queue_regex(aggregator, instance_queue_regex, seed_data):
     check = IbmMqCheck('ibm_mq', {}, {})
     check.check(instance_queue_regex)
 
-    for metric in METRICS:
-        aggregator.assert_metric(metric)
-
-    for metric in OPTIONAL_METRICS:
-        aggregator.assert_metric(metric, at_least=0)
+    aggregator.assert_metrics_present(METRICS)
+    aggregator.assert_metrics_present(OPTIONAL_METRICS, at_least=0)
 
     aggregator.assert_all_metrics_covered()
 
@@ -103,11 +90,8 @@ def test_check_all(aggregator, instance_collect_all, seed_data):
     check = IbmMqCheck('ibm_mq', {}, {})
     check.check(instance_collect_all)
 
-    for metric in METRICS:
-        aggregator.assert_metric(metric)
-
-    for metric in OPTIONAL_METRICS:
-        aggregator.assert_metric(metric, at_least=0)
+    aggregator.assert_metrics_present(METRICS)
+    aggregator.assert_metrics_present(OPTIONAL_METRICS, at_least=0)
 
     aggregator.assert_all_metrics_covered()
 
@@ -151,7 +135,7 @@ def test_check_channel_count(aggregator, instance_queue_regex_tag, seed_data):
     check = IbmMqCheck('ibm_mq', {}, {})
     check._submit_channel_count('my_channel', pymqi.CMQCFC.MQCHS_RUNNING, ["channel:my_channel"])
 
-    for status, expected_value in iteritems(metrics_to_assert):
+    for status, expected_value in metrics_to_assert.items():
         aggregator.assert_metric(
             'ibm_mq.channel.count', expected_value, tags=["channel:my_channel", "status:" + status]
         )
@@ -177,7 +161,7 @@ def test_check_channel_count_status_unknown(aggregator, instance_queue_regex_tag
     check = IbmMqCheck('ibm_mq', {}, {})
     check._submit_channel_count('my_channel', 123, ["channel:my_channel"])
 
-    for status, expected_value in iteritems(metrics_to_assert):
+    for status, expected_value in metrics_to_assert.items():
         aggregator.assert_metric(
             'ibm_mq.channel.count', expected_value, tags=["channel:my_channel", "status:" + status]
         )
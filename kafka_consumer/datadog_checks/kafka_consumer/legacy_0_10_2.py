@@ -10,15 +10,33 @@ from kafka import errors as kafka_errors
 from kafka.client import KafkaClient
 from kafka.protocol.commit import GroupCoordinatorRequest, OffsetFetchRequest
 from kafka.protocol.offset import OffsetRequest, OffsetResetStrategy
-from kafka.structs import TopicPartition
 from kazoo.client import KazooClient
 from kazoo.exceptions import NoNodeError
-from six import iteritems, string_types, text_type
+from kazoo.protocol.states import KazooState
+from six import iteritems, itervalues, string_types, text_type
+from six.moves import intern
 
 from datadog_checks.base import AgentCheck, ConfigurationError, is_affirmative
 
 from .constants import CONTEXT_UPPER_BOUND, DEFAULT_KAFKA_TIMEOUT
 
+# Error codes compared against for every partition of a response
+_NO_ERROR = kafka_errors.NoError.errno
+_NOT_LEADER = kafka_errors.NotLeaderForPartitionError.errno
+_UNKNOWN_TP = kafka_errors.UnknownTopicOrPartitionError.errno
+
+# v0 OffsetRequest partition arguments after the partition ID: the latest offset, only one of them
+_LATEST_ONE = (OffsetResetStrategy.LATEST, 1)
+
+# How long to wait for network events at a time while a broker connection is being established
+_READY_POLL_TIMEOUT_MS = 50
+
+
+def _intern_topic(topic):
+    """Intern a topic name, as it's repeated in the keys of every partition and consumer group."""
+    # Python 2 can only intern byte strings
+    return intern(topic) if isinstance(topic, str) else topic
+
 
 class LegacyKafkaCheck_0_10_2(AgentCheck):
     """
@@ -36,8 +54,18 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
         self._zk_timeout = int(init_config.get('zk_timeout', 5))
         self._kafka_timeout = int(init_config.get('kafka_timeout', DEFAULT_KAFKA_TIMEOUT))
         self._kafka_client = self._create_kafka_client()
+        self._zk_conn = None
+        # Partitions available for each topic, only valid for the duration of a check run
+        self._available_partitions = {}
+        # `topic:` tag of each topic, only valid for the duration of a check run
+        self._topic_tags = {}
         self.context_limit = int(init_config.get('max_partition_contexts', CONTEXT_UPPER_BOUND))
 
+    def cancel(self):
+        """Close the connections kept across check runs once the check is unscheduled."""
+        self._close_zk_conn()
+        self._kafka_client.close()
+
     def check(self, instance):
         # For calculating lag, we have to fetch offsets from both kafka and
         # zookeeper. There's a potential race condition because whichever one we
@@ -62,16 +90,20 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
             consumer_groups = instance.get('consumer_groups')
             self._validate_explicit_consumer_groups(consumer_groups)
 
+        topics = defaultdict(set)
         zk_consumer_offsets = None
         if zk_hosts_ports:
-            zk_consumer_offsets, consumer_groups = self._get_zk_consumer_offsets(
+            zk_consumer_offsets, consumer_groups, topics = self._get_zk_consumer_offsets(
                 zk_hosts_ports, consumer_groups, zk_prefix
             )
 
-        topics = defaultdict(set)
         kafka_consumer_offsets = None
 
+        # Only sends a metadata request once the cached metadata is older than `metadata_max_age_ms`
+        # or a previous run flagged it as stale, see `_process_highwater_offsets`
         self._kafka_client._maybe_refresh_metadata()
+        self._available_partitions.clear()
+        self._topic_tags.clear()
 
         if get_kafka_consumer_offsets:
             # For now, consumer groups are mandatory if not using ZK
@@ -87,9 +119,12 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
             #
             # Kafka 0.8.2 added support for storing consumer offsets in Kafka.
             if self._kafka_client.config.get('api_version') >= (0, 8, 2):
-                kafka_consumer_offsets, topics = self._get_kafka_consumer_offsets(instance, consumer_groups)
+                kafka_consumer_offsets, kafka_topics = self._get_kafka_consumer_offsets(instance, consumer_groups)
+                for topic, partitions in iteritems(kafka_topics):
+                    topics[topic].update(partitions)
 
         if not topics:
+            # Neither Zookeeper nor Kafka returned anything, fall back to the configured topics
             # val = {'consumer_group': {'topic': [0, 1]}}
             for _, tps in iteritems(consumer_groups):
                 for topic, partitions in iteritems(tps):
@@ -114,9 +149,11 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
             return
 
         # Report the broker highwater offset
-        for (topic, partition), highwater_offset in iteritems(highwater_offsets):
-            broker_tags = ['topic:%s' % topic, 'partition:%s' % partition] + custom_tags
-            self.gauge('kafka.broker_offset', highwater_offset, tags=broker_tags)
+        for topic, partition_offsets in iteritems(highwater_offsets):
+            topic_tag = self._get_topic_tag(topic)
+            for partition, highwater_offset in iteritems(partition_offsets):
+                broker_tags = [topic_tag, 'partition:%s' % partition] + custom_tags
+                self.gauge('kafka.broker_offset', highwater_offset, tags=broker_tags)
 
         # Report the consumer group offsets and consumer lag
         if zk_consumer_offsets:
@@ -159,35 +196,51 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
             ssl_password=self.instance.get('ssl_password'),
         )
 
-    def _make_blocking_req(self, request, node_id=None):
+    def _send_req(self, request, node_id=None):
+        """Send a request without waiting for the response, return the future that will hold it."""
         if node_id is None:
             node_id = self._kafka_client.least_loaded_node()
 
+        # ready() also initiates the connection to the broker if needed
         while not self._kafka_client.ready(node_id):
             # poll until the connection to broker is ready, otherwise send()
-            # will fail with NodeNotReadyError
+            # will fail with NodeNotReadyError. Keep the polls short so readiness
+            # is checked again as soon as the connection completes.
+            self._kafka_client.poll(timeout_ms=_READY_POLL_TIMEOUT_MS)
+
+        return self._kafka_client.send(node_id, request)
+
+    def _wait_for_futures(self, futures):
+        """Poll until every future has completed, so that requests sent to different brokers are in flight together."""
+        while not all(future.is_done for future in futures):
             self._kafka_client.poll()
 
-        future = self._kafka_client.send(node_id, request)
-        self._kafka_client.poll(future=future)  # block until we get response.
-        assert future.succeeded()
-        response = future.value
-        return response
+    def _get_response(self, future):
+        # Raise the request's own error, an assert would be stripped when running with `python -O`
+        if future.failed():
+            raise future.exception
+        return future.value
 
     def _process_highwater_offsets(self, response):
-        highwater_offsets = {}
-        topic_partitions_without_a_leader = []
+        # {topic: {partition: offset}}
+        highwater_offsets = defaultdict(dict)
+        topic_partitions_without_a_leader = set()
 
+        # v0 responses hold a list of offsets per partition, v1 responses a single offset after its timestamp
+        single_offset = response.API_VERSION >= 1
         for tp in response.topics:
-            topic = tp[0]
+            topic = _intern_topic(tp[0])
             partitions = tp[1]
-            for partition, error_code, offsets in partitions:
+            for partition_data in partitions:
+                partition, error_code, offsets = partition_data[0], partition_data[1], partition_data[-1]
+                if error_code == _NO_ERROR:
+                    highwater_offsets[topic][partition] = offsets if single_offset else offsets[0]
+                    continue
+
+                # Valid error codes:
+                # https://cwiki.apache.org/confluence/display/KAFKA/A+Guide+To+The+Kafka+Protocol#AGuideToTheKafkaProtocol-PossibleErrorCodes.2
                 error_type = kafka_errors.for_code(error_code)
-                if error_type is kafka_errors.NoError:
-                    highwater_offsets[(topic, partition)] = offsets[0]
-                    # Valid error codes:
-                    # https://cwiki.apache.org/confluence/display/KAFKA/A+Guide+To+The+Kafka+Protocol#AGuideToTheKafkaProtocol-PossibleErrorCodes.2
-                elif error_type is kafka_errors.NotLeaderForPartitionError:
+                if error_code == _NOT_LEADER:
                     self.log.warn(
                         "Kafka broker returned %s (error_code %s) for topic %s, partition: %s. This should only happen "
                         "if the broker that was the partition leader when kafka_admin_client last fetched metadata is "
@@ -197,8 +250,10 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
                         topic,
                         partition,
                     )
-                    topic_partitions_without_a_leader.append((topic, partition))
-                elif error_type is kafka_errors.UnknownTopicOrPartitionError:
+                    topic_partitions_without_a_leader.add((topic, partition))
+                    # Leadership moved since the metadata was fetched, refresh it on the next run
+                    self._kafka_client.cluster.request_update()
+                elif error_code == _UNKNOWN_TP:
                     self.log.warn(
                         "Kafka broker returned %s (error_code %s) for topic: %s, partition: %s. This should only "
                         "happen if the topic is currently being deleted or the check configuration lists non-existent "
@@ -208,6 +263,7 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
                         topic,
                         partition,
                     )
+                    self._kafka_client.cluster.request_update()
                 else:
                     raise error_type(
                         "Unexpected error encountered while attempting to fetch the highwater offsets for topic: %s, "
@@ -216,6 +272,21 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
 
         return highwater_offsets, topic_partitions_without_a_leader
 
+    def _get_available_partitions(self, topic):
+        """Return the partitions of `topic` that have a leader, looked up once per check run."""
+        if topic not in self._available_partitions:
+            # The cluster metadata returns None for unknown topics
+            partitions = self._kafka_client.cluster.available_partitions_for_topic(topic)
+            self._available_partitions[topic] = partitions or set()
+        return self._available_partitions[topic]
+
+    def _get_topic_tag(self, topic):
+        """Return the `topic:` tag of `topic`, formatted once per check run."""
+        topic_tag = self._topic_tags.get(topic)
+        if topic_tag is None:
+            topic_tag = self._topic_tags[topic] = 'topic:%s' % topic
+        return topic_tag
+
     def _get_broker_offsets(self, topics):
         """
         Fetch highwater offsets for each topic/partition from Kafka cluster.
@@ -236,58 +307,85 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
         """
 
         # Connect to Kafka
-        highwater_offsets = {}
-        topic_partitions_without_a_leader = []
+        highwater_offsets = defaultdict(dict)
+        topic_partitions_without_a_leader = set()
         topics_to_fetch = defaultdict(set)
 
         for topic, partitions in iteritems(topics):
             # if no partitions are provided
             # we're falling back to all available partitions (?)
             if len(partitions) == 0:
-                partitions = self._kafka_client.cluster.available_partitions_for_topic(topic)
+                partitions = self._get_available_partitions(topic)
             topics_to_fetch[topic].update(partitions)
 
+        # Read the partition metadata directly rather than through leader_for_partition(), which
+        # would need a TopicPartition built for every single partition
+        cluster_partitions = self._kafka_client.cluster._partitions
         leader_tp = defaultdict(lambda: defaultdict(set))
         for topic, partitions in iteritems(topics_to_fetch):
+            topic_metadata = cluster_partitions.get(topic, {})
             for partition in partitions:
-                partition_leader = self._kafka_client.cluster.leader_for_partition(TopicPartition(topic, partition))
-                if partition_leader is not None and partition_leader >= 0:
-                    leader_tp[partition_leader][topic].add(partition)
+                partition_metadata = topic_metadata.get(partition)
+                if partition_metadata is not None and partition_metadata.leader >= 0:
+                    leader_tp[partition_metadata.leader][topic].add(partition)
 
-        max_offsets = 1
+        # Starting with v1 the request takes a timestamp and always returns a single offset
+        if self._kafka_client.config.get('api_version') >= (0, 10, 1):
+            request_version, partition_args = 1, (OffsetResetStrategy.LATEST,)
+        else:
+            request_version, partition_args = 0, _LATEST_ONE
+
+        futures = []
         for node_id, tps in iteritems(leader_tp):
             # Construct the OffsetRequest
-            request = OffsetRequest[0](
+            request = OffsetRequest[request_version](
                 replica_id=-1,
                 topics=[
-                    (topic, [(partition, OffsetResetStrategy.LATEST, max_offsets) for partition in partitions])
+                    (topic, [(partition,) + partition_args for partition in partitions])
                     for topic, partitions in iteritems(tps)
                 ],
             )
+            futures.append(self._send_req(request, node_id=node_id))
+
+        # Send all the requests before waiting on any of them, the total wait is then bound by the slowest broker
+        self._wait_for_futures(futures)
 
-            response = self._make_blocking_req(request, node_id=node_id)
+        for future in futures:
+            response = self._get_response(future)
             offsets, unled = self._process_highwater_offsets(response)
-            highwater_offsets.update(offsets)
-            topic_partitions_without_a_leader.extend(unled)
+            # A topic's partitions can be led by different brokers
+            for topic, partition_offsets in iteritems(offsets):
+                highwater_offsets[topic].update(partition_offsets)
+            topic_partitions_without_a_leader.update(unled)
 
-        return highwater_offsets, list(set(topic_partitions_without_a_leader))
+        return highwater_offsets, topic_partitions_without_a_leader
 
     def _report_consumer_metrics(self, highwater_offsets, consumer_offsets, unled_topic_partitions=None, tags=None):
         if unled_topic_partitions is None:
-            unled_topic_partitions = []
+            unled_topic_partitions = set()
         if tags is None:
             tags = []
+
+        # Consumer groups share topic partitions, only format their tags once
+        partition_tags = {}
+
+        # Bound once as the loop runs for every consumer group partition
+        gauge = self.gauge
+        log_warn = self.log.warn
+        send_event = self._send_event
+        get_topic_highwater_offsets = highwater_offsets.get
         for (consumer_group, topic, partition), consumer_offset in iteritems(consumer_offsets):
             # Report the consumer group offsets and consumer lag
-            if (topic, partition) not in highwater_offsets:
-                self.log.warn(
+            topic_highwater_offsets = get_topic_highwater_offsets(topic)
+            if topic_highwater_offsets is None or partition not in topic_highwater_offsets:
+                log_warn(
                     "[%s] topic: %s partition: %s was not available in the consumer - skipping consumer submission",
                     consumer_group,
                     topic,
                     partition,
                 )
                 if (topic, partition) not in unled_topic_partitions:
-                    self.log.warn(
+                    log_warn(
                         "Consumer group: %s has offsets for topic: %s "
                         "partition: %s, but that topic partition doesn't actually "
                         "exist in the cluster.",
@@ -297,11 +395,17 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
                     )
                 continue
 
-            consumer_group_tags = ['topic:%s' % topic, 'partition:%s' % partition, 'consumer_group:%s' % consumer_group]
+            topic_partition_tags = partition_tags.get((topic, partition))
+            if topic_partition_tags is None:
+                topic_partition_tags = partition_tags[(topic, partition)] = [
+                    self._get_topic_tag(topic),
+                    'partition:%s' % partition,
+                ]
+            consumer_group_tags = topic_partition_tags + ['consumer_group:%s' % consumer_group]
             consumer_group_tags.extend(tags)
-            self.gauge('kafka.consumer_offset', consumer_offset, tags=consumer_group_tags)
+            gauge('kafka.consumer_offset', consumer_offset, tags=consumer_group_tags)
 
-            consumer_lag = highwater_offsets[(topic, partition)] - consumer_offset
+            consumer_lag = topic_highwater_offsets[partition] - consumer_offset
             if consumer_lag < 0:
                 # this will result in data loss, so emit an event for max visibility
                 title = "Negative consumer lag for group: {group}.".format(group=consumer_group)
@@ -312,21 +416,62 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
                     )
                 )
                 key = "{}:{}:{}".format(consumer_group, topic, partition)
-                self._send_event(title, message, consumer_group_tags, 'consumer_lag', key, severity="error")
+                send_event(title, message, consumer_group_tags, 'consumer_lag', key, severity="error")
                 self.log.debug(message)
 
-            self.gauge('kafka.consumer_lag', consumer_lag, tags=consumer_group_tags)
+            gauge('kafka.consumer_lag', consumer_lag, tags=consumer_group_tags)
 
     def _get_zk_path_children(self, zk_conn, zk_path, name_for_error):
         """Fetch child nodes for a given Zookeeper path."""
-        children = []
-        try:
-            children = zk_conn.get_children(zk_path)
-        except NoNodeError:
-            self.log.info('No zookeeper node at %s', zk_path)
-        except Exception:
-            self.log.exception('Could not read %s from %s', name_for_error, zk_path)
-        return children
+        return self._get_zk_paths_children(zk_conn, [zk_path], name_for_error)[0]
+
+    def _get_zk_paths_children(self, zk_conn, zk_paths, name_for_error):
+        """
+        Fetch child nodes for several Zookeeper paths, returned in the same order as the paths.
+
+        All the requests are sent before waiting on any of them so they're pipelined over the ZK connection.
+        """
+        children_reads = [(zk_path, zk_conn.get_children_async(zk_path)) for zk_path in zk_paths]
+
+        paths_children = []
+        for zk_path, async_result in children_reads:
+            children = []
+            try:
+                children = async_result.get(timeout=self._zk_timeout)
+            except NoNodeError:
+                self.log.info('No zookeeper node at %s', zk_path)
+            except Exception:
+                self.log.exception('Could not read %s from %s', name_for_error, zk_path)
+            paths_children.append(children)
+        return paths_children
+
+    def _get_zk_conn(self, zk_hosts_ports):
+        """
+        Return the Zookeeper client, connecting on first use.
+
+        The client is kept across check runs to avoid setting up a new session every time.
+        If its connection to the ensemble is suspended or its session lost, it is replaced
+        by a new client rather than waiting on Kazoo to recover it.
+        """
+        if self._zk_conn is not None and self._zk_conn.state != KazooState.CONNECTED:
+            self.log.info('Zookeeper connection is %s, reconnecting', self._zk_conn.state)
+            self._close_zk_conn()
+
+        if self._zk_conn is None:
+            zk_conn = KazooClient(zk_hosts_ports, timeout=self._zk_timeout)
+            # Raises if no connection could be established, the next run will try again
+            zk_conn.start()
+            self._zk_conn = zk_conn
+        return self._zk_conn
+
+    def _close_zk_conn(self):
+        """Stop the Zookeeper client, if any, ending its session and threads."""
+        zk_conn, self._zk_conn = self._zk_conn, None
+        if zk_conn is not None:
+            try:
+                zk_conn.stop()
+            finally:
+                zk_conn.close()
 
     def _get_zk_consumer_offsets(self, zk_hosts_ports, consumer_groups=None, zk_prefix=''):
         """
@@ -339,8 +484,12 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
             that you want to fetch offsets for. If consumer_groups is None, will
             fetch offsets for all consumer_groups. For examples of what this
             dict can look like, see _validate_explicit_consumer_groups().
+
+        Returns the offsets, the completed consumer_groups and the partitions
+        of every topic encountered along the way.
         """
         zk_consumer_offsets = {}
+        topics_partitions = defaultdict(set)
 
         # Construct the Zookeeper path pattern
         # /consumers/[groupId]/offsets/[topic]/[partitionId]
@@ -348,110 +497,159 @@ class LegacyKafkaCheck_0_10_2(AgentCheck):
         zk_path_topic_tmpl = zk_path_consumer + '{group}/offsets/'
         zk_path_partition_tmpl = zk_path_topic_tmpl + '{topic}/'
 
-        zk_conn = KazooClient(zk_hosts_ports, timeout=self._zk_timeout)
-        zk_conn.start()
-        try:
-            if consumer_groups is None:
-                # If consumer groups aren't specified, fetch them from ZK
-                consumer_groups = {
-                    consumer_group: None
-                    for consumer_group in self._get_zk_path_children(zk_conn, zk_path_consumer, 'consumer groups')
-                }
-
-            for consumer_group, topics in iteritems(consumer_groups):
-                if not topics:
-                    # If topics are't specified, fetch them from ZK
-                    zk_path_topics = zk_path_topic_tmpl.format(group=consumer_group)
-                    topics = {topic: None for topic in self._get_zk_path_children(zk_conn, zk_path_topics, 'topics')}
-                    consumer_groups[consumer_group] = topics
+        offset_reads = []
+        zk_conn = self._get_zk_conn(zk_hosts_ports)
+
+        if consumer_groups is None:
+            # If consumer groups aren't specified, fetch them from ZK
+            consumer_groups = {
+                consumer_group: None
+                for consumer_group in self._get_zk_path_children(zk_conn, zk_path_consumer, 'consumer groups')
+            }
+
+        # Each level of the tree is fetched for every consumer group at once, so walking
+        # it takes one round trip per level rather than one per node
+
+        # If topics are't specified, fetch them from ZK
+        groups_without_topics = [consumer_group for consumer_group, topics in iteritems(consumer_groups) if not topics]
+        zk_paths_topics = [zk_path_topic_tmpl.format(group=consumer_group) for consumer_group in groups_without_topics]
+        for consumer_group, topics in zip(
+            groups_without_topics, self._get_zk_paths_children(zk_conn, zk_paths_topics, 'topics')
+        ):
+            consumer_groups[consumer_group] = {_intern_topic(topic): None for topic in topics}
+
+        # If partitions aren't specified, fetch them from ZK
+        topics_without_partitions = [
+            (consumer_group, topic)
+            for consumer_group, topics in iteritems(consumer_groups)
+            for topic, partitions in iteritems(topics)
+            if not partitions
+        ]
+        zk_paths_partitions = [
+            zk_path_partition_tmpl.format(group=consumer_group, topic=topic)
+            for consumer_group, topic in topics_without_partitions
+        ]
+        for (consumer_group, topic), partitions in zip(
+            topics_without_partitions, self._get_zk_paths_children(zk_conn, zk_paths_partitions, 'partitions')
+        ):
+            # Zookeeper returns the partition IDs as strings because
+            # they are extracted from the node path
+            consumer_groups[consumer_group][topic] = [int(x) for x in partitions]
+
+        for consumer_group, topics in iteritems(consumer_groups):
+            for topic, partitions in iteritems(topics):
+                partitions = set(partitions)  # defend against bad user input
+                topics_partitions[topic].update(partitions)
+
+                # Queue the consumer offset reads for each partition, they're pipelined over the ZK connection
+                for partition in partitions:
+                    zk_path = (zk_path_partition_tmpl + '{partition}/').format(
+                        group=consumer_group, topic=topic, partition=partition
+                    )
+                    offset_reads.append(((consumer_group, topic, partition), zk_path, zk_conn.get_async(zk_path)))
 
-                for topic, partitions in iteritems(topics):
-                    if partitions:
-                        partitions = set(partitions)  # defend against bad user input
-                    else:
-                        # If partitions aren't specified, fetch them from ZK
-                        zk_path_partitions = zk_path_partition_tmpl.format(group=consumer_group, topic=topic)
-                        # Zookeeper returns the partition IDs as strings because
-                        # they are extracted from the node path
-                        partitions = [
-                            int(x) for x in self._get_zk_path_children(zk_conn, zk_path_partitions, 'partitions')
-                        ]
-                        consumer_groups[consumer_group][topic] = partitions
-
-                    # Fetch consumer offsets for each partition from ZK
-                    for partition in partitions:
-                        zk_path = (zk_path_partition_tmpl + '{partition}/').format(
-                            group=consumer_group, topic=topic, partition=partition
-                        )
-                        try:
-                            consumer_offset = int(zk_conn.get(zk_path)[0])
-                            key = (consumer_group, topic, partition)
-                            zk_consumer_offsets[key] = consumer_offset
-                        except NoNodeError:
-                            self.log.info('No zookeeper node at %s', zk_path)
-                        except Exception:
-                            self.log.exception('Could not read consumer offset from %s', zk_path)
-        finally:
+        for key, zk_path, async_result in offset_reads:
             try:
-                zk_conn.stop()
-                zk_conn.close()
+                zk_consumer_offsets[key] = int(async_result.get(timeout=self._zk_timeout)[0])
+            except NoNodeError:
+                self.log.info('No zookeeper node at %s', zk_path)
             except Exception:
-                self.log.exception('Error cleaning up Zookeeper connection')
-        return zk_consumer_offsets, consumer_groups
+                self.log.exception('Could not read consumer offset from %s', zk_path)
+        return zk_consumer_offsets, consumer_groups, topics_partitions
 
     def _get_kafka_consumer_offsets(self, instance, consumer_groups):
         """
         Get offsets for all consumer groups from Kafka.
 
         These offsets are stored in the __consumer_offsets topic rather than in Zookeeper.
+
+        Each group takes two round trips: one to find its coordinator, then one to that
+        coordinator for the offsets. Each stage is sent for every group before waiting on
+        any response, so the groups are fetched concurrently.
         """
         consumer_offsets = {}
         topics = defaultdict(set)
 
+        coordinator_futures = {}
+        for consumer_group in consumer_groups:
+            try:
+                coordinator_futures[consumer_group] = self._send_req(GroupCoordinatorRequest[0](consumer_group))
+            except Exception:
+                self.log.exception('Could not read consumer offsets from kafka for group: %s', consumer_group)
+        self._wait_for_futures(coordinator_futures.values())
+
+        offset_futures = {}
         for consumer_group, topic_partitions in iteritems(consumer_groups):
+            if consumer_group not in coordinator_futures:
+                continue
             try:
-                single_group_offsets = self._get_single_group_offsets_from_kafka(consumer_group, topic_partitions)
+                coordinator_id = self._get_group_coordinator(self._get_response(coordinator_futures[consumer_group]))
+                if coordinator_id is None:
+                    self.log.info("unable to find group coordinator for %s", consumer_group)
+                    continue
+
+                request = self._get_offset_fetch_request(consumer_group, topic_partitions)
+                offset_futures[consumer_group] = self._send_req(request, node_id=coordinator_id)
+            except Exception:
+                self.log.exception('Could not read consumer offsets from kafka for group: %s', consumer_group)
+        self._wait_for_futures(offset_futures.values())
+
+        for consumer_group, future in iteritems(offset_futures):
+            try:
+                single_group_offsets = self._process_single_group_offsets(self._get_response(future))
+                topic_partitions = consumer_groups[consumer_group]
                 for (topic, partition), offset in iteritems(single_group_offsets):
+                    # Requests for all the group's offsets can return topics that weren't asked for
+                    if topic_partitions and topic not in topic_partitions:
+                        continue
                     topics[topic].update([partition])
                     key = (consumer_group, topic, partition)
                     consumer_offsets[key] = offset
             except Exception:
-                self.log.exception('Could not read consumer offsets from kafka for group: ' % consumer_group)
+                self.log.exception('Could not read consumer offsets from kafka for group: %s', consumer_group)
 
         return consumer_offsets, topics
 
-    def _get_group_coordinator(self, group):
+    def _get_group_coordinator(self, response):
         """Determine which broker is the Group Coordinator for a specific consumer group."""
-        request = GroupCoordinatorRequest[0](group)
-        response = self._make_blocking_req(request)
-        error_type = kafka_errors.for_code(response.error_code)
-        if error_type is kafka_errors.NoError:
+        if response.error_code == _NO_ERROR:
             return response.coordinator_id
 
-    def _get_single_group_offsets_from_kafka(self, consumer_group, topic_partitions):
-        """Get offsets for a single consumer group from Kafka"""
-        consumer_offsets = {}
+    def _get_offset_fetch_request(self, consumer_group, topic_partitions):
+        """Build the request for the offsets of a single consumer group"""
+        # Kafka protocol uses OffsetFetchRequests to retrieve consumer offsets:
+        # https://kafka.apache.org/protocol#The_Messages_OffsetFetch
+        # https://cwiki.apache.org/confluence/display/KAFKA/A+Guide+To+The+Kafka+Protocol#AGuideToTheKafkaProtocol-OffsetFetchRequest
+        if self._kafka_client.config.get('api_version') >= (0, 10, 2) and not any(
+            partitions for partitions in itervalues(topic_partitions or {})
+        ):
+            # No partitions are listed so we need all of them, starting with v2 the coordinator can
+            # return every offset committed by the group in one go when no topics are given
+            return OffsetFetchRequest[2](consumer_group, None)
+
         tps = defaultdict(set)
         for topic, partitions in iteritems(topic_partitions):
             if len(partitions) == 0:
-                partitions = self._kafka_client.cluster.available_partitions_for_topic(topic)
+                partitions = self._get_available_partitions(topic)
             tps[topic] = tps[text_type(topic)].union(set(partitions))
 
-        coordinator_id = self._get_group_coordinator(consumer_group)
-        if coordinator_id is not None:
-            # Kafka protocol uses OffsetFetchRequests to retrieve consumer offsets:
-            # https://kafka.apache.org/protocol#The_Messages_OffsetFetch
-            # https://cwiki.apache.org/confluence/display/KAFKA/A+Guide+To+The+Kafka+Protocol#AGuideToTheKafkaProtocol-OffsetFetchRequest
-            request = OffsetFetchRequest[1](consumer_group, list(iteritems(tps)))
-            response = self._make_blocking_req(request, node_id=coordinator_id)
-            for (topic, partition_offsets) in response.topics:
-                for partition, offset, _, error_code in partition_offsets:
-                    error_type = kafka_errors.for_code(error_code)
-                    if error_type is not kafka_errors.NoError:
-                        continue
-                    consumer_offsets[(topic, partition)] = offset
-        else:
-            self.log.info("unable to find group coordinator for %s", consumer_group)
+        return OffsetFetchRequest[1](consumer_group, list(iteritems(tps)))
+
+    def _process_single_group_offsets(self, response):
+        """Get offsets for a single consumer group from its OffsetFetchResponse"""
+        # Starting with v2 errors affecting the whole group, such as the broker not being
+        # its coordinator, are reported once for the group and no topics are returned
+        error_code = getattr(response, 'error_code', _NO_ERROR)
+        if error_code != _NO_ERROR:
+            raise kafka_errors.for_code(error_code)
+
+        consumer_offsets = {}
+        for (topic, partition_offsets) in response.topics:
+            topic = _intern_topic(topic)
+            for partition, offset, _, error_code in partition_offsets:
+                if error_code != _NO_ERROR:
+                    continue
+                consumer_offsets[(topic, partition)] = offset
 
         return consumer_offsets
 
@@ -7,8 +7,14 @@
 Collects metrics from mesos master node, only the leader is sending metrics.
 """
 
+from multiprocessing import TimeoutError as PoolTimeoutError
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+from threading import Lock
+from time import time
+
 import requests
-from six import iteritems
+import simplejson as json
 from six.moves.urllib.parse import urlparse
 
 from datadog_checks.checks import AgentCheck
@@ -16,12 +22,27 @@ from datadog_checks.config import _is_affirmative
 from datadog_checks.errors import CheckException
 
 
+def _flatten_metrics(*metric_dicts):
+    """Turn metric dicts into a single tuple of (key, metric name, metric function) triples."""
+    return tuple(
+        (key_name, metric_name, metric_func)
+        for metric_dict in metric_dicts
+        for key_name, (metric_name, metric_func) in metric_dict.items()
+    )
+
+
 class MesosMaster(AgentCheck):
     GAUGE = AgentCheck.gauge
     MONOTONIC_COUNT = AgentCheck.monotonic_count
     SERVICE_CHECK_NAME = "mesos_master.can_connect"
     service_check_needed = True
 
+    # Threads fetching the roles and stats, shared by every instance so that none are
+    # left behind when checks are rescheduled. Each run has at most two requests in flight.
+    POOL_SIZE = 4
+    _shared_pool = None
+    _shared_pool_lock = Lock()
+
     FRAMEWORK_METRICS = {
         'cpus': ('mesos.framework.cpu', GAUGE),
         'mem': ('mesos.framework.mem', GAUGE),
@@ -135,51 +156,125 @@ class MesosMaster(AgentCheck):
         'master/valid_status_updates': ('mesos.cluster.valid_status_updates', GAUGE),
     }
 
+    # The dicts above flattened once, as they're iterated on every run
+    _FRAMEWORK_METRIC_ITEMS = _flatten_metrics(FRAMEWORK_METRICS)
+    _ROLE_RESOURCES_METRIC_ITEMS = _flatten_metrics(ROLE_RESOURCES_METRICS)
+    _SYSTEM_METRIC_ITEMS = _flatten_metrics(SYSTEM_METRICS)
+    _LEADER_STATS_METRIC_ITEMS = _flatten_metrics(
+        SYSTEM_METRICS,
+        CLUSTER_TASKS_METRICS,
+        CLUSTER_SLAVES_METRICS,
+        CLUSTER_RESOURCES_METRICS,
+        CLUSTER_REGISTRAR_METRICS,
+        CLUSTER_FRAMEWORK_METRICS,
+        STATS_METRICS,
+    )
+
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
-        for instance in instances or []:
-            url = instance.get('url', '')
-            parsed_url = urlparse(url)
+        # Reused by every request so connections to the masters are kept alive across check runs
+        self._session = requests.Session()
+        # Last version string reported by the master and its parsed form, it rarely changes between runs
+        self._version_cache = (None, None)
+        # Fetches the roles and stats concurrently, only the state has to be known beforehand
+        self._pool = self._get_shared_pool()
+        self.leader = False
+        # Roles responses by endpoint along with when they were fetched, only used if `roles_cache_ttl` is set
+        self._roles_cache = {}
+        self._roles_cache_ttl = float(self.init_config.get('roles_cache_ttl', 0))
+
+        # The tables hold the unbound AgentCheck methods, bind them once for this check
+        framework_metric_items = self._bind_metric_items(self._FRAMEWORK_METRIC_ITEMS)
+        role_resources_metric_items = self._bind_metric_items(self._ROLE_RESOURCES_METRIC_ITEMS)
+        self._system_metric_items = self._bind_metric_items(self._SYSTEM_METRIC_ITEMS)
+        self._leader_stats_metric_items = self._bind_metric_items(self._LEADER_STATS_METRIC_ITEMS)
+        # Settings of each instance by url, they don't change between runs
+        self._instance_configs = {}
+
+        # Every resource is read from the framework and role payloads at once,
+        # then matched with its metric name and function in the same order
+        self._get_framework_resources = itemgetter(*(key_name for key_name, _, _ in framework_metric_items))
+        self._framework_resource_metrics = tuple((name, func) for _, name, func in framework_metric_items)
+        self._get_role_resources = itemgetter(*(key_name for key_name, _, _ in role_resources_metric_items))
+        self._role_resource_metrics = tuple((name, func) for _, name, func in role_resources_metric_items)
+
+    @classmethod
+    def _get_shared_pool(cls):
+        with cls._shared_pool_lock:
+            if cls._shared_pool is None:
+                cls._shared_pool = ThreadPool(cls.POOL_SIZE)
+        return cls._shared_pool
+
+    def _get_instance_config(self, instance):
+        """Return the url, timeout, SSL verification and tags of an instance, only computed on its first run."""
+        url = instance['url']
+        instance_config = self._instance_configs.get(url)
+        if instance_config is None:
+            instance_tags = instance.get('tags', [])
+            if instance_tags is None:
+                instance_tags = []
+            default_timeout = self.init_config.get('default_timeout', 5)
+            timeout = float(instance.get('timeout', default_timeout))
             ssl_verify = not _is_affirmative(instance.get('disable_ssl_validation', False))
-            if not ssl_verify and parsed_url.scheme == 'https':
-                self.log.warning('Skipping SSL cert validation for {0} based on configuration.'.format(url))
+            if not ssl_verify and urlparse(url).scheme == 'https':
+                self.log.warning('Skipping SSL cert validation for %s based on configuration.', url)
+
+            instance_config = self._instance_configs[url] = (url, timeout, ssl_verify, instance_tags)
+        return instance_config
+
+    def _bind_metric_items(self, metric_items):
+        """Replace the metric functions of flattened metric items with the matching methods of this check."""
+        return tuple(
+            (key_name, metric_name, getattr(self, metric_func.__name__))
+            for key_name, metric_name, metric_func in metric_items
+        )
 
     def _get_json(self, url, timeout, verify=True, failure_expected=False, tags=None):
-        tags = tags + ["url:%s" % url] if tags else ["url:%s" % url]
-        msg = None
-        status = None
+        r = None
         try:
-            r = requests.get(url, timeout=timeout, verify=verify)
-            if r.status_code != 200:
-                status = AgentCheck.CRITICAL
-                msg = "Got %s when hitting %s" % (r.status_code, url)
-            else:
-                status = AgentCheck.OK
-                msg = "Mesos master instance detected at %s " % url
+            r = self._session.get(url, timeout=timeout, verify=verify)
         except requests.exceptions.Timeout:
             # If there's a timeout
             msg = "%s seconds timeout when hitting %s" % (timeout, url)
             status = AgentCheck.CRITICAL
-        except Exception as e:
+        except requests.exceptions.RequestException as e:
             msg = str(e)
             status = AgentCheck.CRITICAL
-        finally:
-            self.log.debug('Request to url : {0}, timeout: {1}, message: {2}'.format(url, timeout, msg))
-            self._send_service_check(url, r, status, failure_expected=failure_expected, tags=tags, message=msg)
+        else:
+            if r.status_code != 200:
+                status = AgentCheck.CRITICAL
+                msg = "Got %s when hitting %s" % (r.status_code, url)
+            else:
+                status = AgentCheck.OK
+                msg = "Mesos master instance detected at %s " % url
 
-        if r.encoding is None:
-            r.encoding = 'UTF8'
+        self.log.debug('Request to url : %s, timeout: %s, message: %s', url, timeout, msg)
+        # Raises a CheckException if the request failed, so the response is never parsed then
+        self._send_service_check(url, r, status, failure_expected=failure_expected, tags=tags, message=msg)
 
-        return r.json()
+        # Mesos always answers in UTF-8, decode the raw body directly rather than going through `r.text`
+        return json.loads(r.content)
+
+    def _get_pool_result(self, result, url, timeout):
+        """Wait for a request sent to the pool, with a limit as its workers are shared by every instance."""
+        # The request timeout applies to each network operation, so a slow response can take longer than it
+        wait_timeout = timeout * 2
+        try:
+            return result.get(wait_timeout)
+        except PoolTimeoutError:
+            raise CheckException('{0} seconds timeout waiting for a response from {1}'.format(wait_timeout, url))
 
     def _send_service_check(self, url, response, status, failure_expected=False, tags=None, message=None):
         if status is AgentCheck.CRITICAL and failure_expected:
-            status = AgentCheck.OK
-            message = "Got %s when hitting %s" % (response.status_code, url)
+            # The request didn't get a response at all when it raised
+            if response is not None:
+                message = "Got %s when hitting %s" % (response.status_code, url)
             raise CheckException(message)
         elif status is AgentCheck.CRITICAL and not failure_expected:
             raise CheckException('Cannot connect to mesos. Error: {0}'.format(message))
         if self.service_check_needed:
+            # Only one service check is sent per run, build its tags then
+            tags = (tags or []) + ['url:%s' % url]
             self.service_check(self.SERVICE_CHECK_NAME, status, tags=tags, message=message)
             self.service_check_needed = False
 
@@ -192,92 +287,103 @@ class MesosMaster(AgentCheck):
             # Mesos version < 0.25
             old_endpoint = endpoint + '.json'
             self.log.info(
-                'Unable to fetch state from {0}. Retrying with the deprecated endpoint: {1}.'.format(
-                    endpoint, old_endpoint
-                )
+                'Unable to fetch state from %s. Retrying with the deprecated endpoint: %s.', endpoint, old_endpoint
             )
             master_state = self._get_json(old_endpoint, timeout, verify=verify, tags=tags)
         return master_state
 
     def _get_master_stats(self, url, timeout, verify, tags):
-        if self.version >= [0, 22, 0]:
+        if self.version >= (0, 22, 0):
             endpoint = url + '/metrics/snapshot'
         else:
             endpoint = url + '/stats.json'
-        return self._get_json(endpoint, timeout, verify, tags)
+        return self._get_json(endpoint, timeout, verify=verify, tags=tags)
 
     def _get_master_roles(self, url, timeout, verify, tags):
-        if self.version >= [1, 8, 0]:
+        if self.version >= (1, 8, 0):
             endpoint = url + '/roles'
         else:
             endpoint = url + '/roles.json'
-        return self._get_json(endpoint, timeout, verify, tags)
+
+        if self._roles_cache_ttl:
+            cached_roles = self._roles_cache.get(endpoint)
+            if cached_roles is not None and time() - cached_roles[0] < self._roles_cache_ttl:
+                return cached_roles[1]
+
+        role_metrics = self._get_json(endpoint, timeout, verify=verify, tags=tags)
+        if self._roles_cache_ttl:
+            self._roles_cache[endpoint] = (time(), role_metrics)
+        return role_metrics
 
     def _check_leadership(self, url, timeout, verify, tags=None):
         state_metrics = self._get_master_state(url, timeout, verify, tags)
+        was_leader = self.leader
         self.leader = False
 
         if state_metrics is not None:
-            self.version = [int(i) for i in state_metrics['version'].split('.')]
+            raw_version = state_metrics['version']
+            if raw_version != self._version_cache[0]:
+                self._version_cache = (raw_version, tuple(map(int, raw_version.split('.'))))
+            self.version = self._version_cache[1]
             if state_metrics['leader'] == state_metrics['pid']:
                 self.leader = True
 
+        if self.leader != was_leader:
+            # Cached roles may be from before the election, don't reuse them
+            self._roles_cache.clear()
+
         return state_metrics
 
     def check(self, instance):
         if 'url' not in instance:
             raise Exception('Mesos instance missing "url" value.')
 
-        url = instance['url']
-        instance_tags = instance.get('tags', [])
-        if instance_tags is None:
-            instance_tags = []
-        default_timeout = self.init_config.get('default_timeout', 5)
-        timeout = float(instance.get('timeout', default_timeout))
-        ssl_verify = not _is_affirmative(instance.get('disable_ssl_validation', False))
+        url, timeout, ssl_verify, instance_tags = self._get_instance_config(instance)
 
         state_metrics = self._check_leadership(url, timeout, ssl_verify, instance_tags)
         if state_metrics:
+            # The roles and stats requests are independent, they're in flight while the state is processed
+            role_result = None
+            if self.leader:
+                role_result = self._pool.apply_async(self._get_master_roles, (url, timeout, ssl_verify, instance_tags))
+            stats_result = self._pool.apply_async(self._get_master_stats, (url, timeout, ssl_verify, instance_tags))
+
             tags = ['mesos_pid:{0}'.format(state_metrics['pid']), 'mesos_node:master']
             if 'cluster' in state_metrics:
                 tags.append('mesos_cluster:{0}'.format(state_metrics['cluster']))
 
             tags += instance_tags
 
+            gauge = self.gauge
             if self.leader:
-                self.GAUGE('mesos.cluster.total_frameworks', len(state_metrics['frameworks']), tags=tags)
+                gauge('mesos.cluster.total_frameworks', len(state_metrics['frameworks']), tags=tags)
 
+                # Submitted tags are copied, so a single list is reused with only its last tag
+                # swapped for each framework and role rather than building a new one every time
+                framework_tags = tags + [None]
                 for framework in state_metrics['frameworks']:
-                    framework_tags = ['framework_name:' + framework['name']] + tags
-                    self.GAUGE('mesos.framework.total_tasks', len(framework['tasks']), tags=framework_tags)
-                    resources = framework['used_resources']
-                    for key_name, (metric_name, metric_func) in iteritems(self.FRAMEWORK_METRICS):
-                        metric_func(self, metric_name, resources[key_name], tags=framework_tags)
+                    framework_tags[-1] = 'framework_name:' + framework['name']
+                    gauge('mesos.framework.total_tasks', len(framework['tasks']), tags=framework_tags)
+                    resources = self._get_framework_resources(framework['used_resources'])
+                    for (metric_name, metric_func), value in zip(self._framework_resource_metrics, resources):
+                        metric_func(metric_name, value, tags=framework_tags)
 
-                role_metrics = self._get_master_roles(url, timeout, ssl_verify, instance_tags)
+                role_metrics = self._get_pool_result(role_result, url, timeout)
                 if role_metrics is not None:
+                    role_tags = tags + [None]
                     for role in role_metrics['roles']:
-                        role_tags = ['mesos_role:' + role['name']] + tags
-                        self.GAUGE('mesos.role.frameworks.count', len(role['frameworks']), tags=role_tags)
-                        self.GAUGE('mesos.role.weight', role['weight'], tags=role_tags)
-                        for key_name, (metric_name, metric_func) in iteritems(self.ROLE_RESOURCES_METRICS):
-                            metric_func(self, metric_name, role['resources'][key_name], tags=role_tags)
-
-            stats_metrics = self._get_master_stats(url, timeout, ssl_verify, instance_tags)
+                        role_tags[-1] = 'mesos_role:' + role['name']
+                        gauge('mesos.role.frameworks.count', len(role['frameworks']), tags=role_tags)
+                        gauge('mesos.role.weight', role['weight'], tags=role_tags)
+                        resources = self._get_role_resources(role['resources'])
+                        for (metric_name, metric_func), value in zip(self._role_resource_metrics, resources):
+                            metric_func(metric_name, value, tags=role_tags)
+
+            stats_metrics = self._get_pool_result(stats_result, url, timeout)
             if stats_metrics is not None:
-                metrics = [self.SYSTEM_METRICS]
-                if self.leader:
-                    metrics += [
-                        self.CLUSTER_TASKS_METRICS,
-                        self.CLUSTER_SLAVES_METRICS,
-                        self.CLUSTER_RESOURCES_METRICS,
-                        self.CLUSTER_REGISTRAR_METRICS,
-                        self.CLUSTER_FRAMEWORK_METRICS,
-                        self.STATS_METRICS,
-                    ]
-                for m in metrics:
-                    for key_name, (metric_name, metric_func) in iteritems(m):
-                        if key_name in stats_metrics:
-                            metric_func(self, metric_name, stats_metrics[key_name], tags=tags)
+                metric_items = self._leader_stats_metric_items if self.leader else self._system_metric_items
+                for key_name, metric_name, metric_func in metric_items:
+                    if key_name in stats_metrics:
+                        metric_func(metric_name, stats_metrics[key_name], tags=tags)
 
         self.service_check_needed = True
@@ -4,10 +4,13 @@
 
 import json
 import os
+import threading
 
 import pytest
+import requests
 from six import iteritems
 
+from datadog_checks.errors import CheckException
 from datadog_checks.mesos_master import MesosMaster
 
 CHECK_NAME = 'mesos_master'
@@ -54,3 +57,57 @@ def test_check(check, instance, aggregator):
     aggregator.assert_metric('mesos.framework.total_tasks')
     aggregator.assert_metric('mesos.role.frameworks.count')
     aggregator.assert_metric('mesos.role.weight')
+
+
+def test_roles_cache(instance):
+    check = MesosMaster(CHECK_NAME, {'roles_cache_ttl': 60}, {})
+    check.version = (1, 8, 0)
+    endpoints = []
+
+    def get_json(endpoint, *args, **kwargs):
+        endpoints.append(endpoint)
+        return json.loads(read_fixture('roles.json'))
+
+    check._get_json = get_json
+    url = instance['url']
+
+    roles = check._get_master_roles(url, 5, True, [])
+    assert check._get_master_roles(url, 5, True, []) is roles
+    assert endpoints == [url + '/roles']
+
+    # Cached roles are dropped when the leadership changes
+    check.leader = True
+    check._get_master_state = lambda *args: dict(json.loads(read_fixture('state.json')), leader='other')
+    check._check_leadership(url, 5, True)
+    check._get_master_roles(url, 5, True, [])
+    assert len(endpoints) == 2
+
+
+def test_get_json_request_error(instance):
+    check = MesosMaster(CHECK_NAME, {}, {})
+
+    def get(url, **kwargs):
+        raise requests.exceptions.ConnectionError('Connection refused')
+
+    check._session.get = get
+
+    with pytest.raises(CheckException, match='Connection refused'):
+        check._get_json(instance['url'] + '/state', 5, failure_expected=True)
+    with pytest.raises(CheckException, match='Cannot connect to mesos'):
+        check._get_json(instance['url'] + '/state.json', 5)
+
+
+def test_stuck_request(check, instance):
+    event = threading.Event()
+
+    def get_master_stats(*args):
+        event.wait(5)
+
+    check._get_master_stats = get_master_stats
+    instance = dict(instance, timeout=0.1)
+
+    try:
+        with pytest.raises(CheckException, match='timeout waiting for a response'):
+            check.check(instance)
+    finally:
+        event.set()